@@ -1,11 +1,17 @@
 import asyncio
+import functools
 import json
 import os
-from typing import List
-from dataclasses import dataclass
+import re
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import List, Tuple
+from dataclasses import dataclass, asdict
 from pydantic import BaseModel, Field
-from agents import Agent, Runner, function_tool, InputGuardrail, GuardrailFunctionOutput, InputGuardrailTripwireTriggered
+from agents import Agent, Runner, RunConfig, RunContextWrapper, function_tool, InputGuardrail, GuardrailFunctionOutput, InputGuardrailTripwireTriggered
 from dotenv import load_dotenv
+from openai.types.responses import ResponseTextDeltaEvent
 
 # Load environment variables
 load_dotenv()
@@ -13,6 +19,12 @@ load_dotenv()
 # Set model choice
 model = os.getenv('LLM_MODEL_NAME', 'gpt-4.1-mini')
 
+# Stream answers token by token instead of printing them once complete
+stream_output = os.getenv('STREAM_OUTPUT', '').lower() in ('1', 'true', 'yes')
+
+# Compact JSON for anything sent to the model; whitespace only costs tokens
+JSON_SEPARATORS = (",", ":")
+
 # --- Detailed Data Models ---
 class WorkoutPlan(BaseModel):
     """Workout recommendation with detailed parameters"""
@@ -36,92 +48,104 @@ class GoalAnalysis(BaseModel):
     reasoning: str = Field(description="Explanation of the analysis")
 
 # --- Extended User Context ---
-@dataclass
+# Frozen so a context is hashable and can key caches directly
+@dataclass(frozen=True)
 class UserContext:
     user_id: str
     fitness_level: str  # e.g., Beginner, Intermediate, Advanced
     fitness_goal: str   # e.g., Weight loss, Muscle gain, General fitness
     dietary_preference: str  # e.g., Vegan, Vegetarian, No restrictions
-    available_equipment: List[str]
+    available_equipment: Tuple[str, ...]
     weight_kg: float = 70.0       # Additional personal metric for calorie calculations
     height_cm: float = 170.0      # Additional personal metric for calorie calculations
     age: int = 30               # Additional personal metric for calorie calculations
     gender: str = "male"        # Additional personal metric for calorie calculations
 
+    def __post_init__(self):
+        # Accept any iterable (e.g. a list) but store a tuple so the context stays hashable
+        object.__setattr__(self, "available_equipment", tuple(self.available_equipment))
+
+
+# --- Static Exercise Data ---
+exercise_data = {
+    "chest": [
+        "Push-ups: 3 sets of 10-15 reps",
+        "Bench Press: 3 sets of 8-12 reps",
+        "Chest Flyes: 3 sets of 12-15 reps",
+        "Incline Push-ups: 3 sets of 10-15 reps"
+    ],
+    "back": [
+        "Pull-ups: 3 sets of 6-10 reps",
+        "Bent-over Rows: 3 sets of 8-12 reps",
+        "Lat Pulldowns: 3 sets of 10-12 reps",
+        "Superman Holds: 3 sets of 30 seconds"
+    ],
+    "legs": [
+        "Squats: 3 sets of 10-15 reps",
+        "Lunges: 3 sets of 10 per leg",
+        "Calf Raises: 3 sets of 15-20 reps",
+        "Glute Bridges: 3 sets of 15 reps"
+    ],
+    "arms": [
+        "Bicep Curls: 3 sets of 10-12 reps",
+        "Tricep Dips: 3 sets of 10-15 reps",
+        "Hammer Curls: 3 sets of 10-12 reps",
+        "Overhead Tricep Extensions: 3 sets of 10-12 reps"
+    ],
+    "core": [
+        "Planks: 3 sets of 30-60 seconds",
+        "Crunches: 3 sets of 15-20 reps",
+        "Russian Twists: 3 sets of 20 total reps",
+        "Mountain Climbers: 3 sets of 20 total reps"
+    ]
+}
+
+# Tool responses for each muscle group are static, so serialize them once at import
+_EXERCISE_JSON = MappingProxyType({
+    k: json.dumps({
+        "muscle_group": k,
+        "exercises": v,
+        "recommendation": f"For {k} training, complete exercises with 60-90 seconds rest between sets."
+    }, separators=JSON_SEPARATORS)
+    for k, v in exercise_data.items()
+})
+
 
 @function_tool
 def get_exercise_info(muscle_group: str) -> str:
     """Get a list of exercises for a specific muscle group along with recommendations"""
-    exercise_data = {
-        "chest": [
-            "Push-ups: 3 sets of 10-15 reps",
-            "Bench Press: 3 sets of 8-12 reps",
-            "Chest Flyes: 3 sets of 12-15 reps",
-            "Incline Push-ups: 3 sets of 10-15 reps"
-        ],
-        "back": [
-            "Pull-ups: 3 sets of 6-10 reps",
-            "Bent-over Rows: 3 sets of 8-12 reps",
-            "Lat Pulldowns: 3 sets of 10-12 reps",
-            "Superman Holds: 3 sets of 30 seconds"
-        ],
-        "legs": [
-            "Squats: 3 sets of 10-15 reps",
-            "Lunges: 3 sets of 10 per leg",
-            "Calf Raises: 3 sets of 15-20 reps",
-            "Glute Bridges: 3 sets of 15 reps"
-        ],
-        "arms": [
-            "Bicep Curls: 3 sets of 10-12 reps",
-            "Tricep Dips: 3 sets of 10-15 reps",
-            "Hammer Curls: 3 sets of 10-12 reps",
-            "Overhead Tricep Extensions: 3 sets of 10-12 reps"
-        ],
-        "core": [
-            "Planks: 3 sets of 30-60 seconds",
-            "Crunches: 3 sets of 15-20 reps",
-            "Russian Twists: 3 sets of 20 total reps",
-            "Mountain Climbers: 3 sets of 20 total reps"
-        ]
-    }
-    muscle_group = muscle_group.lower()
-    if muscle_group in exercise_data:
-        exercises = exercise_data[muscle_group]
-        return json.dumps({
-            "muscle_group": muscle_group,
-            "exercises": exercises,
-            "recommendation": f"For {muscle_group} training, complete exercises with 60-90 seconds rest between sets."
-        })
-    else:
-        return f"Exercise information for {muscle_group} is not available."
+    # The model usually sends lowercase names already, so only normalize on a miss
+    response = _EXERCISE_JSON.get(muscle_group)
+    if response is None:
+        muscle_group = muscle_group.lower()
+        response = _EXERCISE_JSON.get(muscle_group, f"Exercise information for {muscle_group} is not available.")
+    return response
 
-@function_tool
-def calculate_calories(goal: str, weight_kg: float, height_cm: float, age: int, gender: str) -> str:
-    """Calculate daily calorie needs and provide macronutrient breakdown based on user stats and goals"""
+# --- Calorie Calculation Tables ---
+# Keys are lowercase; the calculate_calories tool lowercases goal and gender before lookup
+MALE_GENDERS = frozenset({"male", "m"})
+# Mifflin-St Jeor BMR offset by sex
+BMR_OFFSET_MALE, BMR_OFFSET_FEMALE = 5, -161
+# goal -> (calorie adjustment, protein %, fat %, carbs %)
+GOAL_PARAMS = {
+    "weight loss": (-500, 0.40, 0.30, 0.30),  # Rough deficit for weight loss
+    "muscle gain": (300, 0.30, 0.25, 0.45),   # Rough surplus for muscle gain
+}
+DEFAULT_GOAL_PARAMS = (0, 0.30, 0.30, 0.40)
+
+@functools.lru_cache(maxsize=512)
+def _calculate_calories(goal: str, weight_kg: float, height_cm: float, age: int, gender: str) -> Tuple[int, int, int, int]:
+    """Cached (calories, protein, fat, carbs) computation; expects goal and gender already lowercased"""
     # Calculate BMR using Mifflin-St Jeor Equation
-    if gender.lower() in ['male', 'm']:
-        bmr = (10 * weight_kg) + (6.25 * height_cm) - (5 * age) + 5
-    else:
-        bmr = (10 * weight_kg) + (6.25 * height_cm) - (5 * age) - 161
+    bmr_offset = BMR_OFFSET_MALE if gender in MALE_GENDERS else BMR_OFFSET_FEMALE
+    bmr = (10 * weight_kg) + (6.25 * height_cm) - (5 * age) + bmr_offset
 
     # Use a moderate activity factor
     tdee = bmr * 1.55
 
-    # Adjust calorie target based on goal
-    if goal.lower() == "weight loss":
-        calorie_target = tdee - 500  # Rough deficit for weight loss
-    elif goal.lower() == "muscle gain":
-        calorie_target = tdee + 300  # Rough surplus for muscle gain
-    else:
-        calorie_target = tdee
-
-    # Macro breakdown (simplified approach)
-    if goal.lower() == "weight loss":
-        protein_pct, fat_pct, carb_pct = 0.40, 0.30, 0.30
-    elif goal.lower() == "muscle gain":
-        protein_pct, fat_pct, carb_pct = 0.30, 0.25, 0.45
-    else:
-        protein_pct, fat_pct, carb_pct = 0.30, 0.30, 0.40
+    # Adjust calorie target and macro breakdown (simplified approach) based on goal
+    calorie_adjustment, protein_pct, fat_pct, carb_pct = GOAL_PARAMS.get(goal, DEFAULT_GOAL_PARAMS)
+    calorie_target = tdee + calorie_adjustment
 
     protein_cal = calorie_target * protein_pct
     fat_cal = calorie_target * fat_pct
@@ -131,31 +155,124 @@ def calculate_calories(goal: str, weight_kg: float, height_cm: float, age: int,
     fat_grams = round(fat_cal / 9)
     carb_grams = round(carb_cal / 4)
 
+    return round(calorie_target), protein_grams, fat_grams, carb_grams
+
+@function_tool
+def calculate_calories(goal: str, weight_kg: float, height_cm: float, age: int, gender: str) -> str:
+    """Calculate daily calorie needs and provide macronutrient breakdown based on user stats and goals"""
+    daily_calories, protein_grams, fat_grams, carb_grams = _calculate_calories(
+        goal.lower(), weight_kg, height_cm, age, gender.lower()
+    )
     result = {
         "goal": goal,
-        "daily_calories": round(calorie_target),
+        "daily_calories": daily_calories,
         "macros": {
             "protein": protein_grams,
             "fat": fat_grams,
             "carbs": carb_grams
         }
     }
-    return json.dumps(result)
+    return json.dumps(result, separators=JSON_SEPARATORS)
+
+# --- Agent Instructions ---
+# Static instructions stay byte-identical across requests and the per-user context is
+# appended after them, so the provider can reuse its cached prompt prefix between users.
+GOAL_ANALYSIS_INSTRUCTIONS = """
+    Analyze the user's fitness goal. Losing more than 2 pounds per week is generally unsafe.
+    """
+
+WORKOUT_INSTRUCTIONS = """
+    You are a workout specialist. Use the user's fitness level, goal, and available equipment to design a workout plan.
+    Leverage the get_exercise_info tool to retrieve specific exercise recommendations.
+    Provide a clear focus area (e.g., 'upper body', 'cardio') and a difficulty level (Beginner, Intermediate, Advanced) along with form tips.
+    """
+
+NUTRITION_INSTRUCTIONS = """
+    You are a nutrition specialist. Use the user's fitness goal, dietary preferences, and personal stats to calculate daily calorie needs.
+    Leverage the calculate_calories tool to compute calorie targets and macronutrient breakdown.
+    Suggest practical meals that help reach the user's nutrition goals.
+    """
+
+FITNESS_INSTRUCTIONS = """
+    You are a holistic fitness coach. Process general fitness queries while checking the realism of the user's fitness goals.
+    When specific inquiries about workouts or nutrition arise, hand off to the Workout or Nutrition Specialists respectively.
+    Use the provided user context and guardrail function to ensure safety.
+    """
+
+def with_user_context(static_instructions: str, context: RunContextWrapper[UserContext]) -> str:
+    """Append the user's profile after the static instructions"""
+    if context.context is None:
+        return static_instructions
+    user_ctx_json = json.dumps(asdict(context.context), sort_keys=True, separators=JSON_SEPARATORS)
+    return f"{static_instructions}\n### USER CONTEXT\n{user_ctx_json}"
+
+def workout_instructions(context: RunContextWrapper[UserContext], agent: Agent[UserContext]) -> str:
+    return with_user_context(WORKOUT_INSTRUCTIONS, context)
+
+def nutrition_instructions(context: RunContextWrapper[UserContext], agent: Agent[UserContext]) -> str:
+    return with_user_context(NUTRITION_INSTRUCTIONS, context)
+
+def fitness_instructions(context: RunContextWrapper[UserContext], agent: Agent[UserContext]) -> str:
+    return with_user_context(FITNESS_INSTRUCTIONS, context)
 
 # --- Guardrail for Fitness Goals ---
 goal_analysis_agent = Agent(
     name="Goal Analyzer",
-    instructions="""
-    Analyze the user's fitness goal. Losing more than 2 pounds per week is generally unsafe.
-    """,
+    instructions=GOAL_ANALYSIS_INSTRUCTIONS,
     output_type=GoalAnalysis,
     model=model
 )
 
+# Static text first so the cacheable prompt prefix is identical for every request
+GUARDRAIL_PROMPT_PREFIX = "Analyze whether the following fitness goal is realistic and safe.\nUser goal: "
+
+# Obviously unsafe weight-loss rates are caught locally, without an LLM call
+MAX_SAFE_LBS_PER_WEEK = 2.0
+_WEIGHT_LOSS_RATE = re.compile(
+    r"\b(?:lose|drop|shed)\s+(\d+(?:\.\d+)?)\s*(pounds?|lbs?|kgs?|kilos?|kilograms?)"
+    r"\s+in\s+(\d+(?:\.\d+)?|a|one)\s*(days?|weeks?|months?)\b"
+)
+# A negation or someone else earlier in the same sentence makes the match ambiguous
+# ("I don't want to...", "my friend tried to..."), so those are left to the LLM
+_NOT_OWN_GOAL = re.compile(
+    r"\b(?:not|no|never|don'?t|doesn'?t|didn'?t|won'?t|can'?t|shouldn'?t|isn'?t|wasn'?t|"
+    r"he|she|they|his|her|their|someone|somebody|people|friends?|brother|sister|wife|husband|"
+    r"partner|mom|dad|mother|father|son|daughter|client|coworker)\b"
+)
+_SENTENCE_BREAK = re.compile(r"[.!?;\n]")
+_LBS_PER_UNIT = {"p": 1.0, "l": 1.0, "k": 2.20462}
+_WEEKS_PER_UNIT = {"d": 1 / 7, "w": 1.0, "m": 4.345}
+
+def unsafe_weight_loss_rate(text: str):
+    """Return the fastest stated weight-loss rate in lbs/week if it exceeds the safe limit, else None"""
+    text = text.lower().replace("\u2019", "'")
+    fastest = None
+    for match in _WEIGHT_LOSS_RATE.finditer(text):
+        sentence_start = max((b.end() for b in _SENTENCE_BREAK.finditer(text, 0, match.start())), default=0)
+        if _NOT_OWN_GOAL.search(text, sentence_start, match.start()):
+            continue
+        amount, unit, duration, period = match.groups()
+        weeks = (1.0 if duration in ("a", "one") else float(duration)) * _WEEKS_PER_UNIT[period[0]]
+        if weeks <= 0:
+            continue
+        rate = float(amount) * _LBS_PER_UNIT[unit[0]] / weeks
+        if rate > MAX_SAFE_LBS_PER_WEEK and (fastest is None or rate > fastest):
+            fastest = rate
+    return fastest
+
 async def fitness_goal_guardrail(ctx, agent, input_data):
     """Check if the user's fitness goal is realistic and safe."""
+    rate = unsafe_weight_loss_rate(str(input_data))
+    if rate is not None:
+        return GuardrailFunctionOutput(
+            output_info=GoalAnalysis.model_construct(
+                is_realistic=False,
+                reasoning=f"Losing about {rate:.1f} pounds per week exceeds the safe limit of {MAX_SAFE_LBS_PER_WEEK:g} pounds per week."
+            ),
+            tripwire_triggered=True
+        )
     try:
-        analysis_prompt = f"The user said: {input_data}. Analyze whether this fitness goal is realistic and safe."
+        analysis_prompt = GUARDRAIL_PROMPT_PREFIX + str(input_data)
         result = await Runner.run(goal_analysis_agent, analysis_prompt)
         final_output = result.final_output_as(GoalAnalysis)
         return GuardrailFunctionOutput(
@@ -164,7 +281,8 @@ async def fitness_goal_guardrail(ctx, agent, input_data):
         )
     except Exception as e:
         return GuardrailFunctionOutput(
-            output_info=GoalAnalysis(is_realistic=True, reasoning=f"Error analyzing goal: {str(e)}"),
+            # Fields are built locally, so skip Pydantic validation
+            output_info=GoalAnalysis.model_construct(is_realistic=True, reasoning=f"Error analyzing goal: {str(e)}"),
             tripwire_triggered=False
         )
 
@@ -174,11 +292,7 @@ async def fitness_goal_guardrail(ctx, agent, input_data):
 workout_agent = Agent[UserContext](
     name="Workout Specialist",
     handoff_description="Creates personalized workout plans using detailed exercise info.",
-    instructions="""
-    You are a workout specialist. Use the user's fitness level, goal, and available equipment to design a workout plan.
-    Leverage the get_exercise_info tool to retrieve specific exercise recommendations.
-    Provide a clear focus area (e.g., 'upper body', 'cardio') and a difficulty level (Beginner, Intermediate, Advanced) along with form tips.
-    """,
+    instructions=workout_instructions,
     model=model,
     tools=[get_exercise_info],
     output_type=WorkoutPlan
@@ -188,28 +302,221 @@ workout_agent = Agent[UserContext](
 nutrition_agent = Agent[UserContext](
     name="Nutrition Specialist",
     handoff_description="Creates personalized meal plans with calorie and macro targets.",
-    instructions="""
-    You are a nutrition specialist. Use the user's fitness goal, dietary preferences, and personal stats to calculate daily calorie needs.
-    Leverage the calculate_calories tool to compute calorie targets and macronutrient breakdown.
-    Suggest practical meals that help reach the user's nutrition goals.
-    """,
+    instructions=nutrition_instructions,
     model=model,
     tools=[calculate_calories],
     output_type=MealPlan
 )
 
 # Main Fitness Agent with Guardrails and Handoffs
+# The guardrail runs concurrently with the agent's first model call; if it trips, the SDK
+# cancels the in-flight model call, so passing goals cost max(guardrail, agent), not the sum.
 fitness_agent = Agent[UserContext](
     name="Robust Fitness Coach",
-    instructions="""
-    You are a holistic fitness coach. Process general fitness queries while checking the realism of the user's fitness goals.
-    When specific inquiries about workouts or nutrition arise, hand off to the Workout or Nutrition Specialists respectively.
-    Use the provided user context and guardrail function to ensure safety.
-    """,
+    instructions=fitness_instructions,
     model=model,
     handoffs=[workout_agent, nutrition_agent],
-    input_guardrails=[InputGuardrail(guardrail_function=fitness_goal_guardrail)]
+    input_guardrails=[InputGuardrail(guardrail_function=fitness_goal_guardrail, run_in_parallel=True)]
+)
+
+# --- Response Cache for Runner.run ---
+CACHE_TTL_SECONDS = 3600
+CACHE_MAX_ENTRIES = 512
+# (agent name, user context, normalized query) -> (stored_at, output type, payload), oldest first
+_response_cache = OrderedDict()
+# Same key -> task running the agent, so concurrent identical queries share one LLM call
+_inflight_runs = {}
+
+def normalize_query(query: str) -> str:
+    """Lowercase, strip punctuation and collapse whitespace so trivially different phrasings share a key"""
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+def _cache_get(key):
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    stored_at, output_type, payload = entry
+    if time.monotonic() - stored_at >= CACHE_TTL_SECONDS:
+        del _response_cache[key]
+        return None
+    _response_cache.move_to_end(key)
+    if output_type is str:
+        return payload
+    # Output was validated when first produced, so skip re-validation
+    return output_type.model_construct(**payload)
+
+def _cache_put(key, output):
+    if isinstance(output, BaseModel):
+        _response_cache[key] = (time.monotonic(), type(output), output.model_dump())
+    else:
+        _response_cache[key] = (time.monotonic(), str, str(output))
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > CACHE_MAX_ENTRIES:
+        _response_cache.popitem(last=False)
+
+async def _run_and_store(agent, query: str, context, key):
+    try:
+        result = await planned_run(agent, query, context=context)
+        _cache_put(key, result.final_output)
+        return result.final_output
+    finally:
+        _inflight_runs.pop(key, None)
+
+async def cached_run(agent, query: str, context=None):
+    """Run an agent and return its final output, reusing a recent answer for an equivalent query.
+
+    A hit skips the agent's input guardrails by design: a tripped guardrail raises
+    before anything is stored, so only answers that already passed them are cached.
+    """
+    # Different profiles never share cached answers
+    key = (agent.name, context, normalize_query(query))
+    output = _cache_get(key)
+    if output is not None:
+        return output
+
+    task = _inflight_runs.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_run_and_store(agent, query, context, key))
+        _inflight_runs[key] = task
+    # Shield so one cancelled caller doesn't cancel the run other callers are waiting on
+    return await asyncio.shield(task)
+
+# --- Keyword Routing ---
+# Queries that only mention one specialist's vocabulary are routed locally;
+# anything mixed or unmatched still goes through the coach's LLM triage.
+_SPECIALIST_ROUTES = [
+    (re.compile(r"\b(workouts?|work(?:ing)? out|exercises?|reps|sets|strength|cardio|lifting|squats?|push-?ups?|gym)\b"), workout_agent),
+    (re.compile(r"\b(eat|eating|meals?|calories|protein|carbs?|diet|nutrition|food|macros?|recipes?)\b"), nutrition_agent),
+]
+
+def route_query(query: str):
+    """Return the specialist a query unambiguously belongs to, or None"""
+    matches = matching_specialists(query)
+    return matches[0] if len(matches) == 1 else None
+
+def matching_specialists(query: str):
+    """Every specialist whose vocabulary appears in the query"""
+    query = query.lower()
+    return [target for pattern, target in _SPECIALIST_ROUTES if pattern.search(query)]
+
+# --- Plan Cache for Handoffs ---
+PLAN_MATCH_THRESHOLD = 0.6
+PLAN_CACHE_MAX_ENTRIES = 256
+_STOPWORDS = frozenset(
+    "a an and are be can do does for how i in is it me my of on or should so "
+    "the to want what when which with you your".split()
 )
+# (triage agent name, keyword signature) -> specialist agent it handed off to, oldest first
+_plan_cache = OrderedDict()
+
+def query_keywords(query: str) -> frozenset:
+    """Content words of a query, used as its plan signature"""
+    return frozenset(w for w in normalize_query(query).split() if w not in _STOPWORDS)
+
+def _is_routing_word(word: str) -> bool:
+    return any(pattern.search(word) for pattern, _ in _SPECIALIST_ROUTES)
+
+def _lookup_plan(agent, keywords):
+    """Return the cached handoff target for the most similar signature, if similar enough.
+
+    Signatures that differ in a routing word (e.g. "exercises" vs "diet") never match,
+    since that one word is what decides the specialist.
+    """
+    best, best_score = None, 0.0
+    for (agent_name, signature), target in _plan_cache.items():
+        if agent_name != agent.name or not (signature or keywords):
+            continue
+        if any(_is_routing_word(w) for w in signature ^ keywords):
+            continue
+        score = len(signature & keywords) / len(signature | keywords)
+        if score > best_score:
+            best, best_score = target, score
+    return best if best_score >= PLAN_MATCH_THRESHOLD else None
+
+async def planned_run(agent, query: str, context=None):
+    """Run an agent, skipping its triage step when the handoff target is already known.
+
+    The target comes from keyword routing, or failing that from a cached plan for a
+    similar query. The specialist then runs directly, saving the triage LLM call. The
+    triage agent's input guardrails are passed through the run config so they still apply.
+    """
+    keywords = query_keywords(query)
+    target = route_query(query)
+    if target is None:
+        target = _lookup_plan(agent, keywords)
+        # A plan never overrides another specialist's vocabulary in the query
+        if target is not None and any(other is not target for other in matching_specialists(query)):
+            target = None
+    if target is not None and target in agent.handoffs:
+        run_config = RunConfig(input_guardrails=list(agent.input_guardrails))
+        return await Runner.run(target, query, context=context, run_config=run_config)
+
+    result = await Runner.run(agent, query, context=context)
+    if result.last_agent is not agent and result.last_agent in agent.handoffs:
+        key = (agent.name, keywords)
+        _plan_cache[key] = result.last_agent
+        _plan_cache.move_to_end(key)
+        while len(_plan_cache) > PLAN_CACHE_MAX_ENTRIES:
+            _plan_cache.popitem(last=False)
+    return result
+
+# --- Output Labels ---
+# Headers identifying which agent answered, keyed by its output type
+OUTPUT_LABELS = {
+    WorkoutPlan: "\n[👟 WORKOUT SPECIALIST]",
+    MealPlan: "\n[🍎 NUTRITION SPECIALIST]",
+}
+COACH_LABEL = "\n[🏋️ GENERAL FITNESS COACH]"
+GUARDRAIL_LABEL = "\n[⚠️ GUARDRAIL TRIGGERED]"
+ERROR_LABEL = "\n[❌ ERROR]"
+# Specialist name -> output type, so streamed answers can be labelled at handoff time
+SPECIALIST_OUTPUT_TYPES = {agent.name: agent.output_type for agent in (workout_agent, nutrition_agent)}
+
+def describe_failure(e: Exception):
+    """Return the (label, message) to show for a query that raised"""
+    if isinstance(e, InputGuardrailTripwireTriggered):
+        analysis = e.guardrail_result.output.output_info
+        if getattr(analysis, 'reasoning', None):
+            return GUARDRAIL_LABEL, f"Reason: {analysis.reasoning}"
+        return GUARDRAIL_LABEL, "An unrealistic or unsafe fitness goal was detected."
+    return ERROR_LABEL, str(e)
+
+# --- Streaming Output ---
+async def stream_query(agent, query: str, context=None):
+    """Stream an agent's answer, printing the specialist header as soon as the handoff happens.
+
+    Guardrails run in parallel with the agent, so output is held back until every input
+    guardrail has passed; a tripped goal never shows a partial answer.
+    """
+    print("\n" + "="*50)
+    print(f"QUERY: {query}")
+    print("="*50)
+    label_seen = False
+    pending = []
+    try:
+        result = Runner.run_streamed(agent, query, context=context)
+        async for event in result.stream_events():
+            if event.type == "agent_updated_stream_event" and event.new_agent.name in SPECIALIST_OUTPUT_TYPES:
+                pending.append(OUTPUT_LABELS[SPECIALIST_OUTPUT_TYPES[event.new_agent.name]] + "\nRESPONSE:\n")
+                label_seen = True
+            elif event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                # No handoff before the first token means the coach is answering itself
+                if not label_seen:
+                    pending.append(COACH_LABEL + "\nRESPONSE:\n")
+                    label_seen = True
+                pending.append(event.data.delta)
+            guardrails_passed = (
+                len(result.input_guardrail_results) >= len(agent.input_guardrails)
+                and not any(r.output.tripwire_triggered for r in result.input_guardrail_results)
+            )
+            if pending and guardrails_passed:
+                print("".join(pending), end="", flush=True)
+                pending.clear()
+        print("".join(pending))
+    except Exception as e:
+        label, message = describe_failure(e)
+        print(label)
+        print(message)
 
 # --- Demo Function to Showcase the New Agent ---
 async def demo():
@@ -219,7 +526,7 @@ async def demo():
         fitness_level="beginner",
         fitness_goal="I want to lose 20 pounds in 2 weeks",  # This is unrealistic and should trigger the guardrail
         dietary_preference="no restrictions",
-        available_equipment=["dumbbells", "resistance bands"],
+        available_equipment=("dumbbells", "resistance bands"),
         weight_kg=80.0,
         height_cm=175.0,
         age=28,
@@ -232,32 +539,34 @@ async def demo():
         "I want to lose 20 pounds in 2 weeks"
     ]
     
-    for query in queries:
-        print("\n" + "="*50)
-        print(f"QUERY: {query}")
-        print("="*50)
+    if stream_output:
+        # Streamed answers are printed as they arrive, so run queries one at a time
+        for query in queries:
+            await stream_query(fitness_agent, query, context=user_context)
+        return
+    
+    async def handle(query):
         try:
-            result = await Runner.run(fitness_agent, query, context=user_context)
-            
-            # Identify which agent provided the answer
-            if isinstance(result.final_output, WorkoutPlan):
-                print("\n[👟 WORKOUT SPECIALIST]")
-            elif isinstance(result.final_output, MealPlan):
-                print("\n[🍎 NUTRITION SPECIALIST]")
-            else:
-                print("\n[🏋️ GENERAL FITNESS COACH]")
+            output = await cached_run(fitness_agent, query, context=user_context)
             
-            print("RESPONSE:")
-            print(result.final_output)
+            # Identify which agent provided the answer from its output type
+            label = OUTPUT_LABELS.get(type(output), COACH_LABEL)
+            return query, label, "RESPONSE:\n" + str(output)
             
-        except InputGuardrailTripwireTriggered as e:
-            print("\n[⚠️ GUARDRAIL TRIGGERED]")
-            if hasattr(e, 'guardrail_output') and hasattr(e.guardrail_output, 'reasoning'):
-                print(f"Reason: {e.guardrail_output.reasoning}")
-            else:
-                print("An unrealistic or unsafe fitness goal was detected.")
         except Exception as e:
-            print(f"\n[❌ ERROR]: {str(e)}")
+            return (query, *describe_failure(e))
+    
+    # Queries are independent, so run them concurrently and print in order afterwards.
+    # They are deliberately not merged into one prompt: each query needs its own
+    # guardrail verdict and handoff, which a single batched completion cannot give.
+    results = await asyncio.gather(*(handle(q) for q in queries))
+    
+    for query, label, payload in results:
+        print("\n" + "="*50)
+        print(f"QUERY: {query}")
+        print("="*50)
+        print(label)
+        print(payload)
 
 if __name__ == "__main__":
     asyncio.run(demo())